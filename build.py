@@ -8,9 +8,9 @@ import threading
 import zipfile
 import concurrent.futures
 import json
-import re
+import queue
 
-import requests
+from util import SESSION, TIMEOUT
 
 # ================= 配置路径 =================
 # 使用 Pathlib 获取当前脚本所在的目录作为基准路径
@@ -24,39 +24,188 @@ PATH_BUILD_TMP: Path = PATH_BUILD.joinpath("tmp")
 # 下载缓存目录，用于存放下载的 frida-server 压缩包
 PATH_DOWNLOADS: Path = PATH_BASE.joinpath("downloads")
 
+# ================= 读写参数 =================
+# 每次从网络读取的块大小（默认的 8K 太小）
+CHUNK_SIZE = 256 * 1024
+# 写入解压数据时使用的缓冲区大小
+WRITE_BUFFER_SIZE = 1024 * 1024
+# 以原始文件描述符写入压缩包时使用的打开方式（Windows 上需要 O_BINARY）
+ARCHIVE_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+# 下载线程与解压线程之间最多缓存的数据块数量
+PIPELINE_DEPTH = 16
+
+# 打包时跳过的文件（占位文件和 git 配置文件）
+PACKAGE_SKIP_FILES = frozenset(("placeholder", ".gitkeep"))
+
+# ================= 模块信息 =================
+# module.prop 的内容模板（bytes，使用 % 格式化：版本号、versionCode），
+# 注意这里包含硬编码的 updateJson URL，
+# 如果你是 Fork 的项目，这里通常需要修改为自己的仓库地址
+MODULE_PROP_TEMPLATE = b"""id=magisk-frida
+name=MagiskFrida
+version=%s
+versionCode=%d
+author=ViRb3 & enovella
+updateJson=https://github.com/ViRb3/magisk-frida/releases/latest/download/updater.json
+description=Run frida-server on boot"""
+
 # ================= 日志设置 =================
 logger = logging.getLogger()
 syslog = logging.StreamHandler()
-# 日志格式：包含线程名称（因为后面使用了多进程/多线程），方便调试
+# 日志格式：包含线程名称（因为后面使用了多线程），方便调试
 formatter = logging.Formatter("%(threadName)s : %(message)s")
 syslog.setFormatter(formatter)
 logger.setLevel(logging.INFO)
 logger.addHandler(syslog)
 
 
-def download_file(url: str, path: Path):
+def download_file(
+    url: str, path: Path, dest_path: Path, extractor: concurrent.futures.Executor
+):
     """
-    通用下载函数
+    流式下载 .xz 文件并直接解压到目标路径
+    下载在当前线程进行，解压交给 extractor 中的线程，两者形成流水线
     :param url: 下载链接
-    :param path: 本地保存路径
+    :param path: 压缩包的本地缓存路径
+    :param dest_path: 解压后的目标文件路径
+    :param extractor: 用于运行解压任务的线程池
     """
     # 从 URL 中截取文件名用于显示日志
     file_name = url[url.rfind("/") + 1 :]
-    logger.info(f"Downloading '{file_name}' to '{path}'")
+    # 缓存文件对应的 ETag 记录在旁边的 .etag 文件中
+    etag_path = path.with_name(path.name + ".etag")
+    # .xz 文件本身已经是压缩过的，因此要求服务器不要再做传输压缩
+    headers = {"Accept-Encoding": "identity"}
 
-    # 如果文件已存在，则跳过下载（缓存机制）
+    # 如果压缩包已缓存，先确认缓存是否有效（缓存机制）
     if path.exists():
+        if etag_path.exists():
+            # 带上 ETag 发起条件请求，文件未变化时服务器返回 304，不传输内容
+            headers["If-None-Match"] = etag_path.read_text()
+        elif get_remote_size(url) == path.stat().st_size:
+            # 没有 ETag 记录时，只比较文件大小
+            extract_file(path, dest_path)
+            return
+
+    # 确保目标目录存在
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # 通过共享会话发起流式请求，允许重定向，避免把整个响应体读入内存
+    with SESSION.get(
+        url,
+        allow_redirects=True,
+        stream=True,
+        timeout=TIMEOUT,
+        headers=headers,
+    ) as r:
+        # 服务器上的文件没有变化，直接从缓存解压
+        if r.status_code == 304:
+            extract_file(path, dest_path)
+            return
+
+        # 如果状态码不是 200，抛出异常
+        r.raise_for_status()
+        logger.info(f"Downloading '{file_name}' to '{path}'")
+
+        # 先下载到 .part 临时文件，避免中断的下载在缓存中留下不完整的文件
+        part_path = path.with_name(path.name + ".part")
+
+        # 边下载边解压：压缩数据写入临时文件，同时通过队列交给解压线程
+        chunks = queue.Queue(maxsize=PIPELINE_DEPTH)
+        extraction = extractor.submit(decompress_stream, chunks, dest_path)
+        try:
+            # 每个数据块都远大于页大小，直接用 os.write 写入，省去一层 Python 缓冲
+            fd = os.open(part_path, ARCHIVE_OPEN_FLAGS, 0o644)
+            try:
+                preallocate(fd, r.headers.get("Content-Length"))
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    write_all(fd, chunk)
+                    chunks.put(chunk)
+                # 截掉预分配后未写满的部分
+                os.ftruncate(fd, os.lseek(fd, 0, os.SEEK_CUR))
+                # 压缩包不会再被读取，通知内核无需保留它的页缓存
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        finally:
+            # 通知解压线程数据已经结束
+            chunks.put(None)
+
+        # 等待解压完成，并抛出解压过程中可能出现的异常
+        extraction.result()
+
+    # 下载和解压都成功后，才将压缩包和 ETag 放入缓存
+    os.replace(part_path, path)
+    etag = r.headers.get("ETag")
+    if etag:
+        etag_path.write_text(etag)
+    else:
+        etag_path.unlink(missing_ok=True)
+
+    logger.info("Done")
+
+
+def preallocate(fd: int, content_length: str | None):
+    """
+    按响应的 Content-Length 预先为文件分配磁盘空间，减少文件碎片
+    不支持预分配的平台或文件系统上直接跳过
+    """
+    if content_length is None or not hasattr(os, "posix_fallocate"):
         return
+    try:
+        os.posix_fallocate(fd, 0, int(content_length))
+    except OSError:
+        pass
 
-    # 发起请求，允许重定向
-    r = requests.get(url, allow_redirects=True)
-    # 如果状态码不是 200，抛出异常
+
+def write_all(fd: int, data: bytes):
+    """
+    将数据完整写入文件描述符（os.write 可能只写入一部分）
+    """
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def get_remote_size(url: str) -> int | None:
+    """
+    通过 HEAD 请求获取远程文件的大小，不下载文件内容
+    :param url: 文件链接
+    :return: 文件大小，服务器未返回 Content-Length 时返回 None
+    """
+    r = SESSION.head(
+        url,
+        allow_redirects=True,
+        timeout=TIMEOUT,
+        headers={"Accept-Encoding": "identity"},
+    )
     r.raise_for_status()
-    # 以二进制写模式保存文件
-    with open(path, "wb") as f:
-        f.write(r.content)
+    content_length = r.headers.get("Content-Length")
+    return None if content_length is None else int(content_length)
 
-    logger.info("Done")
+
+def decompress_stream(chunks: queue.Queue, dest_path: Path):
+    """
+    从队列中依次取出 .xz 数据块，解压后写入目标文件，直到取到 None 为止
+    :param chunks: 下载线程放入数据块的队列
+    :param dest_path: 解压后的目标文件路径
+    """
+    chunk = b""
+    try:
+        decompressor = lzma.LZMADecompressor()
+        with open(dest_path, "wb", buffering=WRITE_BUFFER_SIZE) as out:
+            while (chunk := chunks.get()) is not None:
+                out.write(decompressor.decompress(chunk))
+        # 数据流提前结束，说明下载的文件不完整
+        if not decompressor.eof:
+            raise lzma.LZMAError(
+                "Compressed data ended before the end-of-stream marker was reached"
+            )
+    finally:
+        # 出错时继续取空队列，避免下载线程阻塞在 put 上
+        while chunk is not None:
+            chunk = chunks.get()
 
 
 def extract_file(archive_path: Path, dest_path: Path):
@@ -67,17 +216,23 @@ def extract_file(archive_path: Path, dest_path: Path):
     """
     logger.info(f"Extracting '{archive_path.name}' to '{dest_path.name}'")
 
-    # 使用 lzma 库打开 .xz 压缩包
-    with lzma.open(archive_path) as f:
-        file_content = f.read() # 读取解压后的数据
-        path = dest_path.parent
+    # 确保目标目录存在
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
 
-        # 确保目标目录存在
-        path.mkdir(parents=True, exist_ok=True)
+    # 分块读取并解压，内存占用只与块大小有关，与文件大小无关
+    decompressor = lzma.LZMADecompressor()
+    with (
+        open(archive_path, "rb") as src,
+        open(dest_path, "wb", buffering=WRITE_BUFFER_SIZE) as out,
+    ):
+        while chunk := src.read(CHUNK_SIZE):
+            out.write(decompressor.decompress(chunk))
 
-        # 将解压后的数据写入目标文件
-        with open(dest_path, "wb") as out:
-            out.write(file_content)
+    # 数据流提前结束，说明压缩包不完整
+    if not decompressor.eof:
+        raise lzma.LZMAError(
+            "Compressed data ended before the end-of-stream marker was reached"
+        )
 
 
 def generate_version_code(project_tag: str) -> int:
@@ -86,32 +241,22 @@ def generate_version_code(project_tag: str) -> int:
     例如: "16.1.4" -> 160104
     """
     # 按 "." 或 "-" 分割版本号
-    parts = re.split("[-.]", project_tag)
+    parts = project_tag.replace("-", ".").split(".")
     # 将每部分转为整数并补零至2位，然后拼接
     version_code = "".join(f"{int(part):02d}" for part in parts)
     return int(version_code)
 
 
-def create_module_prop(path: Path, project_tag: str):
+def create_module_prop(path: Path, project_tag: str, version_code: int):
     """
     生成 Magisk 模块必须的 module.prop 文件
     """
-    # 定义文件内容，注意这里包含硬编码的 updateJson URL，
-    # 如果你是 Fork 的项目，这里通常需要修改为自己的仓库地址
-    module_prop = f"""id=magisk-frida
-name=MagiskFrida
-version={project_tag}
-versionCode={generate_version_code(project_tag)}
-author=ViRb3 & enovella
-updateJson=https://github.com/ViRb3/magisk-frida/releases/latest/download/updater.json
-description=Run frida-server on boot"""
-
-    # 写入文件
-    with open(path.joinpath("module.prop"), "w", newline="\n") as f:
-        f.write(module_prop)
+    # 直接在 bytes 上填充模板，一次写入文件，无需经过文本编码层
+    module_prop = MODULE_PROP_TEMPLATE % (project_tag.encode(), version_code)
+    path.joinpath("module.prop").write_bytes(module_prop)
 
 
-def create_module(project_tag: str):
+def create_module(project_tag: str, version_code: int):
     """
     初始化模块构建环境
     """
@@ -122,21 +267,34 @@ def create_module(project_tag: str):
         shutil.rmtree(PATH_BUILD_TMP)
 
     # 将 base 目录下的所有模板文件复制到临时构建目录
-    shutil.copytree(PATH_BASE_MODULE, PATH_BUILD_TMP)
+    # 优先使用硬链接，避免每次构建都复制文件内容
+    # 注意：硬链接与模板共享数据，构建过程中不能原地修改这些文件，只能新建文件
+    try:
+        shutil.copytree(PATH_BASE_MODULE, PATH_BUILD_TMP, copy_function=os.link)
+    except OSError:
+        # 跨文件系统或文件系统不支持硬链接时，退回普通复制
+        shutil.rmtree(PATH_BUILD_TMP, ignore_errors=True)
+        shutil.copytree(PATH_BASE_MODULE, PATH_BUILD_TMP)
     # 生成 prop 文件
-    create_module_prop(PATH_BUILD_TMP, project_tag)
+    create_module_prop(PATH_BUILD_TMP, project_tag, version_code)
 
 
-def fill_module(arch: str, frida_tag: str, project_tag: str):
+def fill_module(
+    arch: str,
+    frida_tag: str,
+    project_tag: str,
+    extractor: concurrent.futures.Executor,
+):
     """
     【核心工作函数】下载并填充特定架构的 Frida Server
-    此函数会被多进程并发调用
+    此函数会被多线程并发调用
     :param arch: 架构名称 (如 arm64, x86)
     :param frida_tag: Frida 的版本号 (如 16.1.4)
     :param project_tag: 项目版本号
+    :param extractor: 用于运行解压任务的线程池
     """
-    # 设置当前线程/进程名称，方便日志区分是哪个架构正在下载
-    threading.current_thread().setName(arch)
+    # 设置当前线程名称，方便日志区分是哪个架构正在下载
+    threading.current_thread().name = arch
     logger.info(f"Filling module for arch '{arch}'")
 
     # 构造 GitHub 下载链接
@@ -147,20 +305,21 @@ def fill_module(arch: str, frida_tag: str, project_tag: str):
     frida_server = f"frida-server-{frida_tag}-android-{arch}.xz"
     frida_server_path = PATH_DOWNLOADS.joinpath(frida_server)
 
-    # 1. 下载文件到 downloads 目录
-    download_file(frida_download_url + frida_server, frida_server_path)
-
-    # 准备解压目录：build/tmp/files
+    # 解压目录：build/tmp/files
     # 注意：这里并不是放入 system/bin，而是放入 files 目录，
     # 意味着这是一个 "All-in-One" 包，安装时脚本会从 files 里挑对应的文件
     files_dir = PATH_BUILD_TMP.joinpath("files")
-    files_dir.mkdir(exist_ok=True)
 
-    # 2. 解压文件并重命名为 frida-server-arm64
-    extract_file(frida_server_path, files_dir.joinpath(f"frida-server-{arch}"))
+    # 下载文件到 downloads 目录，同时解压并重命名为 frida-server-arm64
+    download_file(
+        frida_download_url + frida_server,
+        frida_server_path,
+        files_dir.joinpath(f"frida-server-{arch}"),
+        extractor,
+    )
 
 
-def create_updater_json(project_tag: str):
+def create_updater_json(project_tag: str, version_code: int):
     """
     生成 updater.json，用于 Magisk 管理器检测更新
     """
@@ -168,19 +327,62 @@ def create_updater_json(project_tag: str):
 
     updater = {
         "version": project_tag,
-        "versionCode": generate_version_code(project_tag),
+        "versionCode": version_code,
         "zipUrl": f"https://github.com/ViRb3/magisk-frida/releases/download/{project_tag}/MagiskFrida-{project_tag}.zip",
         "changelog": "https://raw.githubusercontent.com/ViRb3/magisk-frida/master/CHANGELOG.md",
     }
 
-    # 写入 json 文件，格式化缩进为 4 空格
+    # 写入 json 文件，该文件只供程序读取，使用紧凑格式即可
     with open(PATH_BUILD.joinpath("updater.json"), "w", newline="\n") as f:
-        f.write(json.dumps(updater, indent=4))
+        f.write(json.dumps(updater, separators=(",", ":")))
+
+
+def get_compresslevel(file_name: str) -> int | None:
+    """
+    为 zip 包中的单个文件选择压缩级别
+    frida-server 是解压后的 ELF 文件，压缩率可观，保持默认级别以控制发布包体积；
+    其余都是几 KB 的脚本，使用最快的级别 1 即可
+    """
+    if file_name.startswith("frida-server-"):
+        return None
+    return 1
 
 
-def package_module(project_tag: str):
+def iter_module_files(root: str):
     """
-    将构建好的临时目录打包成 .zip 文件
+    递归遍历目录，返回需要打包的文件路径
+    使用 os.scandir，其 DirEntry 自带文件类型信息，无需额外的 stat 调用
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_module_files(entry.path)
+            # 排除占位文件和 git 配置文件
+            elif entry.name not in PACKAGE_SKIP_FILES:
+                yield entry.path
+
+
+def write_zip_entry(zf: zipfile.ZipFile, src: str, arcname: str):
+    """
+    以 1 MB 的块将单个文件写入 zip 包
+    zf.write 内部每次只读 8 KB，对几十 MB 的 frida-server 来说系统调用过多
+    """
+    # from_file 会保留文件的修改时间和权限位
+    zinfo = zipfile.ZipInfo.from_file(src, arcname)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    # 与 zf.write 的做法一致，按文件设置压缩级别
+    zinfo._compresslevel = get_compresslevel(os.path.basename(src))
+
+    with (
+        open(src, "rb", buffering=WRITE_BUFFER_SIZE) as fin,
+        zf.open(zinfo, "w", force_zip64=False) as fout,
+    ):
+        shutil.copyfileobj(fin, fout, length=WRITE_BUFFER_SIZE)
+
+
+def package_module(project_tag: str, version_code: int):
+    """
+    将构建好的临时目录打包成 .zip 文件，并生成对应的 updater.json
     """
     logger.info("Packaging module")
 
@@ -189,22 +391,19 @@ def package_module(project_tag: str):
 
     # 创建 zip 文件，使用 DEFLATED 压缩算法
     with zipfile.ZipFile(module_zip, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        # 临时目录路径的长度（含末尾分隔符），用于截取 zip 包内的相对路径
+        base_len = len(str(PATH_BUILD_TMP)) + 1
         # 遍历临时目录下的所有文件
-        for root, _, files in os.walk(PATH_BUILD_TMP):
-            for file_name in files:
-                # 排除占位文件和 git 配置文件
-                if file_name == "placeholder" or file_name == ".gitkeep":
-                    continue
-                # 将文件写入 zip 包
-                zf.write(
-                    Path(root).joinpath(file_name), # 源文件路径
-                    # 在 zip 包内的相对路径
-                    arcname=Path(root).relative_to(PATH_BUILD_TMP).joinpath(file_name),
-                )
+        for file_path in iter_module_files(str(PATH_BUILD_TMP)):
+            # 将文件写入 zip 包，zip 包内统一使用 "/" 作为路径分隔符
+            write_zip_entry(zf, file_path, file_path[base_len:].replace(os.sep, "/"))
 
     # 打包完成后删除临时构建目录
     shutil.rmtree(PATH_BUILD_TMP)
 
+    # 生成与 zip 包配套的更新信息
+    create_updater_json(project_tag, version_code)
+
 
 def do_build(frida_tag: str, project_tag: str):
     """
@@ -214,30 +413,39 @@ def do_build(frida_tag: str, project_tag: str):
     PATH_DOWNLOADS.mkdir(parents=True, exist_ok=True)
     PATH_BUILD.mkdir(parents=True, exist_ok=True)
 
+    # 版本号只需计算一次，module.prop 和 updater.json 共用
+    version_code = generate_version_code(project_tag)
+
     # 1. 创建模块骨架
-    create_module(project_tag)
+    create_module(project_tag, version_code)
 
     # 定义需要下载的架构列表
     archs = ["arm", "arm64", "x86", "x86_64"]
 
     # 2. 并发下载与处理
-    # 使用进程池执行器 (ProcessPoolExecutor) 来并行处理任务
-    # 这会同时启动 4 个进程，分别下载不同架构的文件，大大加快速度
-    executor = concurrent.futures.ProcessPoolExecutor()
-    futures = [
-        # 提交任务给进程池: fill_module(arch, frida_tag, project_tag)
-        executor.submit(fill_module, arch, frida_tag, project_tag) for arch in archs
-    ]
-
-    # 等待所有任务完成，并捕获可能的异常
-    for future in concurrent.futures.as_completed(futures):
-        if future.exception() is not None:
-            raise future.exception()
-
-    # 3. 打包 zip
-    package_module(project_tag)
-
-    # 4. 生成更新信息
-    create_updater_json(project_tag)
+    # 下载是 I/O 密集型任务；lzma 解压虽然是 CPU 密集型任务，但其 C 实现在解压时会释放 GIL，
+    # 多个解压线程可以同时跑满多个核心。因此两者都使用线程池 (ThreadPoolExecutor)，
+    # 避免多进程的启动开销，也无需把数据块在进程间来回复制
+    # 下载与解压分别使用两个线程池：某个架构的数据在解压时，下载线程可以继续读取网络数据
+    # 每个下载任务同时只占用一个解压线程，因此两个线程池大小相同，保证不会互相等待
+    with (
+        concurrent.futures.ThreadPoolExecutor(max_workers=len(archs)) as executor,
+        concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(archs), thread_name_prefix="xz"
+        ) as extractor,
+    ):
+        futures = [
+            # 提交任务给线程池: fill_module(arch, frida_tag, project_tag, extractor)
+            executor.submit(fill_module, arch, frida_tag, project_tag, extractor)
+            for arch in archs
+        ]
+
+        # 等待所有任务完成，并捕获可能的异常
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                raise future.exception()
+
+    # 3. 打包 zip 并生成更新信息
+    package_module(project_tag, version_code)
 
     logger.info("Done")
\ No newline at end of file
@@ -1,10 +1,41 @@
+import functools
+import os
 import re
 import requests
 import subprocess
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# ================= HTTP 会话 =================
+
+# 全局共享的 HTTP 会话，复用连接池，避免每次请求都重新进行 DNS 解析和 TLS 握手
+# 构建时的多个下载线程也共用这个会话
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=8,
+    # 遇到 GitHub 偶发的限流或 5xx 错误时，以指数退避方式自动重试
+    max_retries=Retry(
+        total=5,
+        backoff_factor=1.0,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(("GET", "HEAD")),
+    ),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
+# 请求超时时间：(连接超时, 读取超时)，单位为秒
+# 所有请求都必须带上超时，避免连接卡死导致整个构建挂起
+TIMEOUT = (5, 120)
 
 
 # ================= 版本号处理工具 =================
 
+# 用于按 '.' 或 '-' 拆分版本号的正则，在模块加载时编译一次
+_TAG_SPLIT = re.compile(r"[.-]")
+
 # 将带修订号的版本 tag 还原为基础版本
 # 例如: 输入 "12.7.5-2" -> 输出 "12.7.5"
 # 逻辑: 以第一个 '-' 为界限分割字符串，取前半部分
@@ -14,14 +45,30 @@ def strip_revision(tag) -> str:
 
 # ================= GitHub API 交互 =================
 
+# GraphQL 查询：只取最新发布的 tag 名称，响应只有几百字节
+_LATEST_RELEASE_QUERY = """
+query($owner: String!, $name: String!) {
+  repository(owner: $owner, name: $name) {
+    latestRelease { tagName }
+  }
+}
+"""
+
+
 # 获取指定 GitHub 仓库的最新发布 (Release) Tag
 # 参数 project_name: 格式为 "owner/repo"，例如 "frida/frida"
 def get_last_github_tag(project_name) -> str:
+    # GraphQL API 必须鉴权，GitHub Actions 中可以直接使用 GITHUB_TOKEN
+    # 没有 token 时（例如本地构建）退回 REST API
+    token = os.getenv("GITHUB_TOKEN")
+    if token:
+        return get_last_github_tag_graphql(project_name, token)
+
     # GitHub 官方 API 地址
     releases_url = f"https://api.github.com/repos/{project_name}/releases/latest"
 
-    # 发送 HTTP GET 请求
-    r = requests.get(releases_url)
+    # 通过共享会话发送 HTTP GET 请求
+    r = SESSION.get(releases_url, timeout=TIMEOUT)
     # 如果响应状态码不是 200 (例如 404 或 403 限流)，则抛出异常
     r.raise_for_status()
 
@@ -32,6 +79,30 @@ def get_last_github_tag(project_name) -> str:
     return last_release
 
 
+# 通过 GitHub GraphQL API 获取最新发布的 Tag
+# 与 REST API 返回完整的 release 信息（约 20 KB）相比，只返回需要的字段
+def get_last_github_tag_graphql(project_name, token) -> str:
+    owner, name = project_name.split('/', 1)
+
+    r = SESSION.post(
+        "https://api.github.com/graphql",
+        json={"query": _LATEST_RELEASE_QUERY, "variables": {"owner": owner, "name": name}},
+        headers={"Authorization": f"bearer {token}"},
+        timeout=TIMEOUT,
+    )
+    r.raise_for_status()
+
+    result = r.json()
+    # GraphQL 出错时 HTTP 状态码仍然是 200，错误信息在 "errors" 字段中
+    if "errors" in result:
+        raise RuntimeError(f"GitHub GraphQL query failed: {result['errors']}")
+
+    latest_release = result["data"]["repository"]["latestRelease"]
+    if latest_release is None:
+        raise RuntimeError(f"No release found for '{project_name}'")
+    return latest_release["tagName"]
+
+
 # 封装函数：专门获取 frida/frida 官方仓库的最新版本 Tag
 def get_last_frida_tag() -> str:
     last_frida_tag = get_last_github_tag('frida/frida')
@@ -56,19 +127,30 @@ def get_last_project_tag() -> str:
 def sort_tags(tags: [str]) -> [str]:
     tags = tags.copy()
     s: str
-    # key=lambda... : 定义排序规则
-    # re.split(r"[\.-]", s): 按 '.' 或 '-' 分割字符串
+    # key=lambda... : 定义排序规则（sort 对每个元素只计算一次 key）
+    # _TAG_SPLIT.split(s): 按 '.' 或 '-' 分割字符串
     # map(int, ...): 将分割后的部分转为整数，以便进行数值比较
-    tags.sort(key=lambda s: list(map(int, re.split(r"[\.-]", s))))
+    tags.sort(key=lambda s: tuple(map(int, _TAG_SPLIT.split(s))))
     return tags
 
 
 # 获取符合特定过滤条件的最新 Tag
-# 参数 filter_args: 传递给 git tag -l 的参数，例如匹配模式
+# 参数 filter_args: 匹配模式，例如 ["12.7.5-*"]，为空时匹配所有 tag
 def get_last_tag(filter_args: [str]) -> str:
-    # 1. 执行 git tag -l 获取所有 tag
-    # 2. splitlines() 将结果按行分割成列表
-    tags = exec_git_command(["tag", "-l"] + filter_args).splitlines()
+    if git_supports_version_sort():
+        # git 自身支持按版本号倒序排序，并只返回第一个结果，
+        # 无需把全部 tag 取回 Python 中排序
+        # 注意：v:refname 的排序会受用户 git 配置 versionsort.suffix 影响，
+        # 只有在默认配置下才与 sort_tags 的结果一致（例如设置了 versionsort.suffix=-，
+        # 16.1.4 会排在 16.1.4-10 之后，被当成最新的 tag）
+        pattern = "refs/tags/" + filter_args[0] if filter_args else "refs/tags"
+        # 输出完整的 refname 再去掉前缀：%(refname:short) 在存在同名分支时会返回 "tags/<name>"
+        ref = exec_git_command(["for-each-ref", "--sort=-v:refname", "--count=1",
+                                "--format=%(refname)", pattern]).strip()
+        return ref.removeprefix("refs/tags/")
+
+    # 旧版本 git：获取（已缓存的）tag 列表
+    tags = list(list_tags(*filter_args))
 
     # 如果没有找到 tag，返回空字符串
     # 否则，调用 sort_tags 进行正确排序，并取最后一个（最大的版本号）
@@ -76,6 +158,24 @@ def get_last_tag(filter_args: [str]) -> str:
     return last_tag
 
 
+# 检查本地 git 是否支持 for-each-ref 的 --sort=v:refname（git 2.7 起支持）
+@functools.cache
+def git_supports_version_sort() -> bool:
+    # 输出形如 "git version 2.39.5"
+    version = exec_git_command(["--version"]).split()[2]
+    major, minor = map(int, version.split(".")[:2])
+    return (major, minor) >= (2, 7)
+
+
+# 列出符合过滤条件的所有 Tag
+# 结果会被缓存，同样的查询在一次运行中只会执行一次 git 命令
+@functools.cache
+def list_tags(*filter_args: str) -> frozenset[str]:
+    # 1. 执行 git tag -l 获取所有 tag
+    # 2. splitlines() 将结果按行分割
+    return frozenset(exec_git_command(["tag", "-l", *filter_args]).splitlines())
+
+
 # 执行系统 Git 命令的底层封装
 # 参数 command_with_args: 命令列表，例如 ["tag", "-l"]
 def exec_git_command(command_with_args: [str]) -> str:
@@ -92,12 +192,10 @@ def exec_git_command(command_with_args: [str]) -> str:
 # 它会依次检查 12.7.5-1, 12.7.5-2 是否已存在
 # 直到找到一个未被占用的 tag
 def get_next_revision(current_tag: str) -> str:
+    # 一次性取出所有 12.7.5-* 形式的 tag，之后只在内存中查找，
+    # 避免每检查一个修订号就执行一次 git 命令
+    existing = list_tags(f"{current_tag}-*")
     i = 1
-    while True:
-        new_tag = f"{current_tag}-{i}"
-        # 检查这个 tag 是否存在于本地 git 仓库
-        if get_last_tag([new_tag]) == '':
-            # 如果 get_last_tag 返回空，说明这个 tag 还没人用，可以使用
-            break
+    while f"{current_tag}-{i}" in existing:
         i += 1
-    return new_tag
\ No newline at end of file
+    return f"{current_tag}-{i}"